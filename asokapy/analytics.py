@@ -0,0 +1,382 @@
+#!/usr/bin/python3
+
+import os
+import bisect
+import time
+
+import numpy
+
+#Datalog format (see Server.report_data):
+#<timestamp> <tab> <mac> <tab> <is_on: 1/0/empty> <tab> <power: W/empty>
+
+class DatalogIndex:
+    """Sparse time index of a datalog: file offset of the first line of
+    each period (one hour by default). It is stored next to the datalog
+    (<datalog>.idx) and updated incrementally, so only new lines are
+    scanned."""
+    filename = None
+    index_filename = None
+    resolution = None
+
+    #Sorted list of period start timestamps, and corresponding offsets
+    _times = None
+    _offsets = None
+    #Offset up to which the datalog was indexed
+    _indexed = 0
+
+    def __init__(self, filename, resolution = 3600):
+        self.filename = filename
+        self.index_filename = filename + '.idx'
+        self.resolution = resolution
+        self._times = []
+        self._offsets = []
+        self._indexed = 0
+
+    def _load(self):
+        self._times = []
+        self._offsets = []
+        self._indexed = 0
+
+        if not os.path.exists(self.index_filename):
+            return
+
+        with open(self.index_filename, 'r') as f:
+            header = f.readline().split('\t')
+            if len(header) != 2 or int(header[0]) != self.resolution:
+                return
+            indexed = int(header[1])
+
+            for line in f:
+                t, offset = line.split('\t')
+                self._times.append(int(t))
+                self._offsets.append(int(offset))
+
+        #Datalog was truncated or rotated: rebuild from scratch
+        if indexed > os.path.getsize(self.filename):
+            self._times = []
+            self._offsets = []
+            return
+
+        self._indexed = indexed
+
+    def _save(self):
+        tmp_filename = self.index_filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            f.write('{0}\t{1}\n'.format(self.resolution, self._indexed))
+            for t, offset in zip(self._times, self._offsets):
+                f.write('{0}\t{1}\n'.format(t, offset))
+        os.replace(tmp_filename, self.index_filename)
+
+    def update(self):
+        """Index lines appended since the last update"""
+        self._load()
+
+        last_period = self._times[-1] if len(self._times) > 0 else None
+        offset = self._indexed
+
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                #Incomplete line (being written)
+                if not line.endswith(b'\n'):
+                    break
+
+                try:
+                    period = int(float(line[:line.index(b'\t')]) // self.resolution) * self.resolution
+                except ValueError:
+                    period = None
+
+                if period is not None and (last_period is None or period > last_period):
+                    self._times.append(period)
+                    self._offsets.append(offset)
+                    last_period = period
+
+                offset += len(line)
+
+        self._indexed = offset
+        self._save()
+
+    def seek_offset(self, since):
+        """Returns the offset from where to read to get lines newer than since"""
+        if since is None:
+            return 0
+        i = bisect.bisect_right(self._times, since) - 1
+        if i < 0:
+            return 0
+        return self._offsets[i]
+
+def _split_lines(lines):
+    """Split lines one by one, returns the flat list of fields of the
+    valid lines only"""
+    fields = []
+    for line in lines:
+        x = line.rstrip(b'\n').split(b'\t')
+        if len(x) != 4:
+            continue
+        try:
+            float(x[0])
+            if x[3] != b'':
+                float(x[3])
+        except ValueError:
+            continue
+        fields.extend(x)
+    return fields
+
+def _convert(fields):
+    """Convert a flat list of fields (4 per line) to (times, macs, is_on,
+    power) numpy arrays, raises ValueError if a value is invalid"""
+    times = numpy.array(fields[0::4]).astype('f8')
+    macs = numpy.array(fields[1::4]).astype('U17')
+    is_on_str = numpy.array(fields[2::4])
+    is_on = numpy.where(is_on_str == b'1', 1, numpy.where(is_on_str == b'0', 0, -1)).astype('i1')
+    power_str = numpy.array(fields[3::4])
+    power_str[power_str == b''] = b'nan'
+    power = power_str.astype('f8')
+    return times, macs, is_on, power
+
+def read_chunks(filename, since = None, until = None, chunk_size = 1<<22, index = None):
+    """Read the datalog by chunks of about chunk_size bytes, yields
+    (times, macs, is_on, power) numpy arrays. is_on is -1 if unknown,
+    power is NaN if unknown."""
+    offset = 0
+    if index is not None:
+        offset = index.seek_offset(since)
+
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        while True:
+            lines = f.readlines(chunk_size)
+            if len(lines) == 0:
+                break
+
+            #Incomplete last line (being written)
+            if not lines[-1].endswith(b'\n'):
+                lines = lines[:-1]
+            if len(lines) == 0:
+                continue
+
+            #Split all fields at once, fall back to line by line if
+            #some lines are malformed (e.g. partial line of an unclean
+            #shutdown merged with the next one)
+            fields = b''.join(lines).replace(b'\n', b'\t').split(b'\t')[:-1]
+            try:
+                if len(fields) != 4 * len(lines):
+                    raise ValueError("Malformed lines")
+                times, macs, is_on, power = _convert(fields)
+            except ValueError:
+                fields = _split_lines(lines)
+                if len(fields) == 0:
+                    continue
+                times, macs, is_on, power = _convert(fields)
+
+            mask = numpy.ones(len(times), dtype = bool)
+            if since is not None:
+                mask &= (times >= since)
+            if until is not None:
+                mask &= (times < until)
+
+            yield times[mask], macs[mask], is_on[mask], power[mask]
+
+            #Datalog is written chronologically
+            if until is not None and times[-1] >= until:
+                break
+
+def _group(macs):
+    """Group rows by device: returns a list of (mac, indexes of its rows,
+    in original order)"""
+    keys, inverse = numpy.unique(macs, return_inverse = True)
+    order = numpy.argsort(inverse, kind = 'stable')
+    bounds = numpy.cumsum(numpy.bincount(inverse, minlength = len(keys)))[:-1]
+    return zip([str(x) for x in keys], numpy.split(order, bounds))
+
+def _forward_fill(values, valid):
+    """Replace invalid values by the last valid one (the first ones stay invalid)"""
+    idx = numpy.where(valid, numpy.arange(len(values)), 0)
+    numpy.maximum.accumulate(idx, out = idx)
+    filled = values[idx]
+    #Before the first valid value
+    first_valid = numpy.argmax(valid) if valid.any() else len(values)
+    return filled, numpy.arange(len(values)) >= first_valid
+
+class DeviceStats:
+    """Energy and usage statistics of one device, accumulated over
+    consecutive chunks of its samples (the last sample of a chunk is
+    carried over to the next one).
+
+    Power is integrated trapezoidally between samples. Intervals longer
+    than max_gap (device offline, server stopped) are ignored. When the
+    device is known to be off, power is 0. Daily energy is attributed to
+    the day of the start of each interval (days start at day_offset
+    seconds from midnight UTC). Percentiles are weighted by the time
+    each power value was held."""
+    max_gap = None
+    day_offset = None
+
+    #Last sample of previous chunk: (time, is_on, power), filled
+    _last = None
+
+    samples = 0
+    energy = 0. #Wh
+    covered_time = 0. #s
+    on_time = 0.
+    state_time = 0.
+    peak = None
+    #Map: <day start timestamp> => energy (Wh)
+    daily = None
+    #Power (in 0.1 W, the datalog resolution), and time at this power
+    _power_keys = None
+    _power_weights = None
+
+    def __init__(self, max_gap = 300, day_offset = 0):
+        self.max_gap = max_gap
+        self.day_offset = day_offset
+        self._last = None
+        self.daily = {}
+        self._power_keys = numpy.zeros(0, dtype = 'i8')
+        self._power_weights = numpy.zeros(0, dtype = 'f8')
+
+    def add(self, times, is_on, power):
+        """Add chronological samples of the device"""
+        if len(times) == 0:
+            return
+        self.samples += len(times)
+
+        measured = power[~numpy.isnan(power)]
+        if len(measured) > 0:
+            self.peak = max(self.peak if self.peak is not None else measured.max(), measured.max())
+
+        if self._last is not None:
+            times = numpy.concatenate(([self._last[0]], times))
+            is_on = numpy.concatenate(([self._last[1]], is_on))
+            power = numpy.concatenate(([self._last[2]], power))
+
+        #Known state/power at each sample
+        state, state_known = _forward_fill(is_on, is_on >= 0)
+        power_filled, power_known = _forward_fill(power, ~numpy.isnan(power))
+        power_eff = numpy.where(state_known & (state == 0), 0., power_filled)
+        known = power_known | (state_known & (state == 0))
+
+        self._last = (times[-1], state[-1] if state_known[-1] else -1, power_filled[-1] if power_known[-1] else numpy.nan)
+
+        dt = numpy.diff(times)
+        in_gap = (dt > 0) & (dt <= self.max_gap)
+        valid = in_gap & known[:-1] & known[1:]
+
+        energy_parts = numpy.where(valid, (power_eff[:-1] + power_eff[1:]) / 2. * dt, 0.) / 3600.
+        self.energy += energy_parts.sum()
+        self.covered_time += dt[valid].sum()
+
+        on_valid = in_gap & state_known[:-1]
+        self.on_time += dt[on_valid & (state[:-1] == 1)].sum()
+        self.state_time += dt[on_valid].sum()
+
+        #Power held during each interval
+        held = in_gap & known[:-1]
+        keys = numpy.concatenate((self._power_keys, numpy.round(power_eff[:-1][held] * 10).astype('i8')))
+        weights = numpy.concatenate((self._power_weights, dt[held]))
+        self._power_keys, inverse = numpy.unique(keys, return_inverse = True)
+        self._power_weights = numpy.bincount(inverse, weights = weights, minlength = len(self._power_keys))
+
+        if len(dt) > 0:
+            days = numpy.floor((times[:-1] - self.day_offset) / 86400.).astype('i8')
+            first_day = days.min()
+            per_day = numpy.bincount(days - first_day, weights = energy_parts)
+            for i in numpy.nonzero(per_day)[0]:
+                day = int(first_day + i) * 86400 + self.day_offset
+                self.daily[day] = self.daily.get(day, 0.) + float(per_day[i])
+
+    def percentiles(self, percentiles):
+        """Time-weighted percentiles of power, map: <percentile> => W"""
+        total = self._power_weights.sum()
+        if total <= 0:
+            return {}
+        cumulative = numpy.cumsum(self._power_weights)
+        result = {}
+        for p in percentiles:
+            i = min(numpy.searchsorted(cumulative, p / 100. * total, side = 'left'), len(cumulative) - 1)
+            result[p] = self._power_keys[i] / 10.
+        return result
+
+    def result(self, percentiles = (50, 95, 99)):
+        return {
+            'samples': self.samples,
+            'energy': float(self.energy), #Wh
+            'covered_time': float(self.covered_time), #s
+            'duty_cycle': float(self.on_time / self.state_time) if self.state_time > 0 else None,
+            'peak': float(self.peak) if self.peak is not None else None,
+            'percentiles': self.percentiles(percentiles),
+            'daily': dict(self.daily),
+        }
+
+def analyze_datalog(filename, since = None, until = None, macs = None, max_gap = 300, day_offset = 0, chunk_size = 1<<22, index = None):
+    """Compute statistics of each device (or only macs) over the datalog,
+    by chunks. Returns a map: <mac> => DeviceStats"""
+    stats = {}
+    for times, chunk_macs, is_on, power in read_chunks(filename, since, until, chunk_size, index):
+        for mac, rows in _group(chunk_macs):
+            if macs is not None and mac not in macs:
+                continue
+            if mac not in stats:
+                stats[mac] = DeviceStats(max_gap, day_offset)
+            stats[mac].add(times[rows], is_on[rows], power[rows])
+    return stats
+
+def analyze(times, is_on, power, max_gap = 300, percentiles = (50, 95, 99), day_offset = 0):
+    """Compute energy and usage statistics of one device (see DeviceStats)"""
+    stats = DeviceStats(max_gap, day_offset)
+    stats.add(times, is_on, power)
+    return stats.result(percentiles)
+
+def _parse_time(value):
+    """Parse a timestamp, or a date as YYYY-MM-DD[THH:MM[:SS]] (local time)"""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise ValueError("Invalid time {0}!".format(value))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'Energy and usage statistics from an asokapy datalog')
+    parser.add_argument('datalog')
+    parser.add_argument('--since', help = 'timestamp or YYYY-MM-DD[THH:MM[:SS]]')
+    parser.add_argument('--until', help = 'timestamp or YYYY-MM-DD[THH:MM[:SS]]')
+    parser.add_argument('--mac', action = 'append', help = 'only this device (can be repeated)')
+    parser.add_argument('--max-gap', type = float, default = 300, help = 'ignore intervals longer than this (s)')
+    parser.add_argument('--percentiles', default = '50,95,99')
+    parser.add_argument('--daily', action = 'store_true', help = 'print energy per day')
+    parser.add_argument('--no-index', action = 'store_true', help = "don't use/update the time index")
+    args = parser.parse_args()
+
+    index = None
+    if not args.no_index:
+        index = DatalogIndex(args.datalog)
+        index.update()
+
+    percentiles = [float(x) for x in args.percentiles.split(',') if x != '']
+    #Local midnight
+    day_offset = time.altzone if time.daylight and time.localtime().tm_isdst else time.timezone
+
+    data = analyze_datalog(args.datalog, _parse_time(args.since), _parse_time(args.until), args.mac, args.max_gap, day_offset, index = index)
+
+    print('\t'.join(['mac', 'samples', 'kWh', 'duty', 'peak'] + ['p{0:g}'.format(p) for p in percentiles]))
+    for mac in sorted(data.keys()):
+        stats = data[mac].result(percentiles)
+
+        fields = [mac, str(stats['samples']), '{0:1.3f}'.format(stats['energy'] / 1000.)]
+        fields.append('' if stats['duty_cycle'] is None else '{0:1.3f}'.format(stats['duty_cycle']))
+        fields.append('' if stats['peak'] is None else '{0:1.1f}'.format(stats['peak']))
+        fields += ['{0:1.1f}'.format(stats['percentiles'][p]) if p in stats['percentiles'] else '' for p in percentiles]
+        print('\t'.join(fields))
+
+        if args.daily:
+            for day, energy in sorted(stats['daily'].items()):
+                print('\t'.join(['', time.strftime('%Y-%m-%d', time.localtime(day)), '{0:1.3f}'.format(energy / 1000.)]))
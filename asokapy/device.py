@@ -2,24 +2,81 @@ import collections
 import weakref
 import struct
 import time
+import random
 from asokapy.pib import PIB
 
 #Device is a state machine, which states are defined here.
 #See doc/device_states.dot for transitions.
 
-#Probing state (only ethernet)
-DSProbing = collections.namedtuple('DSProbing', ['last_sent', 'num_sent'])
-#Probing state (ethernet + HomePlugAV)
-DSProbingHP = collections.namedtuple('DSProbingHP', ['last_sent'])
+#Probing state (only ethernet), next probe is sent delay after last_sent
+DSProbing = collections.namedtuple('DSProbing', ['last_sent', 'num_sent', 'delay'])
+#Probing state (ethernet + HomePlugAV), with exponential backoff
+DSProbingHP = collections.namedtuple('DSProbingHP', ['last_sent', 'num_sent', 'delay'])
 
+#In the PIB states, start_time is the time of the last progress (state
+#entered or chunk acknowledged), not counting time waiting for the
+#provisioning byte budget
 #Read PIB from device
 DSReadPIB = collections.namedtuple('DSReadPIB', ['start_time','last_sent', 'pib'])
 #Write PIB to device
 DSWritePIB = collections.namedtuple('DSWritePIB', ['start_time','last_sent', 'pib_current_offset', 'pib'])
-#Write PIB to NVM (only one packet)
-DSWritePIBToNVM = collections.namedtuple('DSWritePIBToNVM', ['start_time','last_sent'])
+#Write PIB to NVM (only one packet), pib is the PIB written
+DSWritePIBToNVM = collections.namedtuple('DSWritePIBToNVM', ['start_time','last_sent', 'pib'])
 #Running state
 DSRunning = collections.namedtuple('DSRunning', ['last_sent','last_received'])
+#Running state restored from a previous run, not confirmed yet by the
+#device (only ethernet probes, next one is sent delay after last_sent)
+DSVerifying = collections.namedtuple('DSVerifying', ['last_sent', 'num_sent', 'delay'])
+
+#Content of a power information message
+#Blue device (type '2'): unknown is a 3-tuple, version a 2-tuple
+#White device (type '3'): unknown is a string, version a 1-tuple
+PowerData = collections.namedtuple('PowerData', ['device_type', 'is_on', 'power', 'version', 'unknown'])
+
+def parse_powerdata(data):
+    """Parse a power information message (bytes, fields separated by ';'),
+    returns PowerData, or None if the message is malformed"""
+    try:
+        parts = data.decode('ascii').strip().split(';')
+    except UnicodeDecodeError:
+        return None
+    
+    if len(parts) < 5 or parts[3] not in ('0', '1'):
+        return None
+    
+    try:
+        power = float(parts[4])
+    except ValueError:
+        return None
+    
+    if parts[0] == '2' and len(parts) >= 8:
+        return PowerData(parts[0], parts[3] == '1', power, (parts[2], parts[7]), (parts[1], parts[5], parts[6]))
+    if parts[0] == '3':
+        return PowerData(parts[0], parts[3] == '1', power, (parts[2], ), parts[1])
+    return None
+
+#Ethernet messages (64-bytes chunks: function, length, data)
+EtherProbe = b'\x00\x00\x00' + b'\x00'*60 + b'\x01'
+EtherOn = b'\x08\x01\x01' + b'\x00'*60 + b'\x00'
+EtherOff = b'\x08\x01\x00' + b'\x00'*60 + b'\x01'
+#Map: <function of request> => <function of reply>
+EtherReplies = {0: 1, 8: 9}
+#Functions only sent by a PL7667 (power information, reply to on/off, unsollicited)
+EtherDeviceFunctions = (1, 9, 12)
+#Maximum number of chunks in one frame (length is one byte)
+EtherMaxChunks = 3
+
+def hp_read_pib_request(offset, length):
+    """HomePlugAV Read Module Data Request (PIB), without mac addresses"""
+    msg = b'\x88\xe1' #HomePlug AV
+    msg += b'\x00' #v1.0
+    msg += struct.pack('<H',0xa024) #Read Module Data Request
+    msg += b'\x00\xb0\x52' #Vendor MME OUI
+    msg += b'\x02' #Module ID: PIB
+    msg += b'\x00' #Reserved
+    msg += struct.pack('<H',length)
+    msg += struct.pack('<I',offset)
+    return msg
 
 class Device:
     #weakref to server
@@ -30,6 +87,23 @@ class Device:
     interval = None
     remote_mac = None
     
+    #Adaptive polling (enabled if interval_max is set): the interval
+    #between probes grows from interval to interval_max by
+    #interval_backoff while power is stable within tolerance (W)
+    interval_max = None
+    interval_backoff = 2.
+    tolerance = 1.
+    #Upper bound of interval_max: gaps longer than 300 s are considered as
+    #outages by the history and the analytics (max_gap), keep a margin for
+    #probe jitter and replies
+    interval_max_limit = 240.
+    #Current interval between probes
+    poll_interval = None
+    #Number of probes sent in DSRunning, and number of probes saved
+    #compared to polling every interval
+    probes_sent = 0
+    probes_saved = 0.
+    
     #state
     state = None
     
@@ -44,8 +118,46 @@ class Device:
     device_power = None
     device_is_on = None
     
+    #In-memory history (see asokapy.history), managed by the server
+    history = None
+    history_settings = None
+    
+    #Power readings within deadband (W) of the last logged one, with
+    #the same on/off state, are not logged (but at least every
+    #report_max_interval seconds)
+    deadband = 0.
+    report_max_interval = 60
+    #Last logged reading (time, is_on, power), and last reading not logged
+    last_logged = None
+    suppressed = None
+    
+    #Priority for provisioning (PIB rewrite), higher first
+    priority = 0
+    #PIB state interrupted by a timeout, to resume from
+    pib_resume = None
+    #Number of consecutive times we didn't get a provisioning slot
+    slot_refused = 0
+    slot_max_delay = 60 #Maximum delay between probes while waiting for a slot
+    slot_probe_length = 64 #Length of PIB read while waiting for a slot
+    
+    #Send several ethernet messages in one frame
+    coalesce = False
+    #Outbound ethernet messages, sent by flush_ether
+    ether_queue = None
+    #Coalesced frames waiting for replies: [sent time, expected reply functions, replies received]
+    pending_frames = None
+    #Number of consecutive coalesced frames only partially answered
+    partial_replies = 0
+    #The status query was sent with the switch command, skip the next probe
+    skip_probe = False
+    reply_timeout = 5 #Time (s) to wait for all replies to a coalesced frame
+    max_partial_replies = 3 #Disable coalescing after this number of partial replies
+    
     #Config
     probe_delay = 10 #delay between probe in DSProbing state
+    probe_backoff = 2 #Factor applied to the delay after each probe in DSProbingHP state
+    probe_max_delay = 300 #Maximum delay between probes in DSProbingHP state
+    probe_jitter = 0.2 #Random variation (+/-) of the delay between probes
     max_probing_tries = 5 #Number of probes to send
     pib_chunk = 1024 #Chunk size of PIB read
     pib_abort_time = 20 #Timeout (s) in DS*PIB* states
@@ -54,54 +166,114 @@ class Device:
     def __init__(self, server, remote_mac):
         self.server = weakref.proxy(server)
         self.remote_mac = remote_mac
+        self.probes_sent = 0
+        self.probes_saved = 0.
+        self.ether_queue = []
+        self.pending_frames = []
         self.reset_state()
         
-    def reset_state(self):
-        self.state = DSProbing(last_sent = 0, num_sent = 0)
+    def reset_state(self, delay = 0):
+        """Go back to probing state, first probe is sent after delay"""
+        #Last reading of a steady run
+        self.flush_suppressed()
+        self.server._provisioning.release(self.remote_mac)
+        self.state = DSProbing(last_sent = time.time(), num_sent = 0, delay = delay)
         #No indication about power
         self.device_power = None
         self.device_is_on = None
         
-    def update_config(self, values):
-        if 'interval' in values:
-            self.interval = int(values['interval'])
-        else:
-            self.interval = None
-            
-        if 'alias' in values:
-            self.alias = values['alias']
+    def parse_config(self, values):
+        """Parse and check config values, returns a map: <attribute> => value
+        (raises ValueError if invalid, see update_config)"""
+        config = {}
+        config['interval'] = int(values['interval']) if 'interval' in values else None
+        config['alias'] = values.get('alias')
+        
+        if 'interval_max' in values and config['interval'] is not None:
+            config['interval_max'] = max(min(float(values['interval_max']), self.interval_max_limit), config['interval'])
         else:
-            self.alias = None
-            
+            config['interval_max'] = None
+        
+        config['priority'] = int(values.get('priority', 0))
+        
+        config['deadband'] = float(values.get('deadband', 0.))
+        config['report_max_interval'] = float(values.get('report_max_interval', 60))
+        
+        config['coalesce'] = values.get('coalesce', '0').lower() in ('1', 'yes', 'true', 'on')
+        
+        config['interval_backoff'] = float(values.get('interval_backoff', 2.))
+        if config['interval_backoff'] <= 1:
+            raise ValueError("Invalid interval_backoff {0} for {1}, must be > 1!".format(config['interval_backoff'], self.remote_mac))
+        config['tolerance'] = float(values.get('tolerance', 1.))
+        return config
+        
+    def apply_config(self, config):
+        """Apply config returned by parse_config"""
+        for k, v in config.items():
+            setattr(self, k, v)
+        self.poll_interval = self.interval
+        
+    def update_config(self, values):
+        self.apply_config(self.parse_config(values))
+        
     def tick(self):
         if self.state.__class__ == DSProbing:
-            #Send a probe every probe_delay
-            if self.state.last_sent < time.time() - self.probe_delay:
+            #Send a probe every probe_delay (with jitter)
+            if self.state.last_sent < time.time() - self.state.delay:
                 self.send_ether_probe()
                 
                 #Maybe we're not the master, so we need to probe homeplug too
                 if self.state.num_sent >= self.max_probing_tries:
-                    self.state = DSProbingHP(last_sent = time.time())
+                    self.state = DSProbingHP(last_sent = time.time(), num_sent = 0, delay = self.probe_backoff_delay(0))
                 else:
-                    self.state = DSProbing(last_sent = time.time(), num_sent = self.state.num_sent + 1)
+                    self.state = DSProbing(last_sent = time.time(), num_sent = self.state.num_sent + 1, delay = self.jitter(self.probe_delay))
             return
         
         if self.state.__class__ == DSProbingHP:
-            #Send ethernet and HomePlugAV probes every probe_delay
-            if self.state.last_sent < time.time() - self.probe_delay:
+            #Send ethernet and HomePlugAV probes, with exponential backoff
+            #(the device is probably offline)
+            if self.state.last_sent < time.time() - self.state.delay:
                 self.send_ether_probe()
-                self.send_hp_probe()
-                self.state = DSProbingHP(last_sent = time.time())
+                if self.slot_refused > 0:
+                    #Waiting for a provisioning slot: we only need an
+                    #answer, read the beginning of the PIB only
+                    if self.server._provisioning.consume(self.slot_probe_length):
+                        self.send_hp_read_pib(0, self.slot_probe_length)
+                else:
+                    self.send_hp_probe()
+                num_sent = self.state.num_sent
+                #Stop counting once we reached probe_max_delay
+                if self.probe_delay * self.probe_backoff ** num_sent < self.probe_max_delay:
+                    num_sent += 1
+                self.state = DSProbingHP(last_sent = time.time(), num_sent = num_sent, delay = self.probe_backoff_delay(num_sent))
+            return
+        
+        if self.state.__class__ == DSVerifying:
+            if self.state.last_sent < time.time() - self.state.delay:
+                #No answer: status is unknown, probe from scratch
+                if self.state.num_sent >= self.max_probing_tries:
+                    self.reset_state()
+                    return
+                self.send_ether_probe()
+                self.state = DSVerifying(last_sent = time.time(), num_sent = self.state.num_sent + 1, delay = self.jitter(self.probe_delay))
             return
         
         if self.state.__class__ == DSRunning:
             #If we want to switch on/off, and it doesn't correspond to current state
             if self.device_is_on != self.want_on and self.want_on is not None:
-                #Send correct packet
+                #Poll fast until the switch is done
+                self.poll_interval = self.interval
+                #Send correct packet, followed by a status query if
+                #it can be sent in the same frame
                 if self.want_on:
-                    self.send_ether_on()
+                    self.queue_ether_on()
                 else:
-                    self.send_ether_off()
+                    self.queue_ether_off()
+                if self.coalesce:
+                    #This is the next scheduled status query
+                    self.queue_ether_probe()
+                    self.skip_probe = True
+                self.flush_ether()
                 #It seems to be best to wait a little before doing another query
                 self.state = DSRunning(last_sent = time.time(), last_received = self.state.last_received)
                 return
@@ -109,12 +281,22 @@ class Device:
             #Do we want to query at some fixed interval?
             if self.interval is not None:
                 #Too long without receiving packet: abort
-                if time.time() - self.state.last_received > self.running_abort_time:
-                    self.reset_state()
+                if time.time() - self.state.last_received > max(self.running_abort_time, 2 * self.poll_interval):
+                    self.reset_state(self.jitter(self.probe_delay) / 2)
                     return
                 
-                #Send a probe every interval
-                if self.state.last_sent < time.time() - self.interval:
+                #Send a probe every poll_interval
+                if self.state.last_sent < time.time() - self.poll_interval:
+                    #Already sent with the switch command
+                    if self.skip_probe:
+                        self.skip_probe = False
+                        self.state = DSRunning(last_sent = time.time(), last_received = self.state.last_received)
+                        return
+                    
+                    #Probes we would have sent every interval since the last one
+                    if self.interval_max is not None and self.state.last_sent > 0:
+                        self.probes_saved += self.poll_interval / self.interval - 1.
+                    self.probes_sent += 1
                     self.send_ether_probe()
                     self.state = DSRunning(last_sent = time.time(), last_received = self.state.last_received)
             return
@@ -122,19 +304,34 @@ class Device:
         #Handle timeout in PIB state
         if self.state.__class__ in (DSReadPIB, DSWritePIB, DSWritePIBToNVM):
             if self.state.start_time < time.time() - self.pib_abort_time:
+                #No progress: give the slot to another device, we'll resume from
+                #the last acknowledged offset once we get a slot again
+                self.pib_resume = self.state
+                self.server._provisioning.release(self.remote_mac, False)
                 self.reset_state()
+                #We know that we're not the master of this device
+                self.state = DSProbingHP(last_sent = time.time(), num_sent = 0, delay = self.jitter(self.probe_delay) / 2)
                 return
             
         #In the 3 PIB states, we send a packet every probe_delay if we
         #don't get an answer. (maybe the packet was lost?)
         if self.state.__class__ == DSReadPIB:
             if self.state.last_sent < time.time() - self.probe_delay:
-                self.send_hp_read_pib(len(self.state.pib), min(self.state.pib.size() - len(self.state.pib),self.pib_chunk))
+                length = min(self.state.pib.size() - len(self.state.pib),self.pib_chunk)
+                #Wait for the provisioning byte budget (not counted as a timeout)
+                if not self.server._provisioning.consume(length):
+                    self.state = DSReadPIB(start_time=time.time(),last_sent=self.state.last_sent,pib=self.state.pib)
+                    return
+                self.send_hp_read_pib(len(self.state.pib), length)
                 self.state = DSReadPIB(start_time=self.state.start_time,last_sent=time.time(),pib=self.state.pib)
             return
             
         if self.state.__class__ == DSWritePIB:
             if self.state.last_sent < time.time() - self.probe_delay:
+                #Wait for the provisioning byte budget
+                if not self.server._provisioning.consume(len(self.state.pib[self.state.pib_current_offset:self.state.pib_current_offset+self.pib_chunk])):
+                    self.state = DSWritePIB(start_time=time.time(),last_sent=self.state.last_sent,pib_current_offset=self.state.pib_current_offset,pib=self.state.pib)
+                    return
                 self.send_hp_write_pib()
                 self.state = DSWritePIB(start_time=self.state.start_time,last_sent=time.time(),pib_current_offset=self.state.pib_current_offset,pib=self.state.pib)
             return
@@ -142,12 +339,64 @@ class Device:
         if self.state.__class__ == DSWritePIBToNVM:
             if self.state.last_sent < time.time() - self.probe_delay:
                 self.send_hp_write_pib_to_nvm()
-                self.state = DSWritePIBToNVM(start_time=self.state.start_time,last_sent=time.time())
+                self.state = DSWritePIBToNVM(start_time=self.state.start_time,last_sent=time.time(),pib=self.state.pib)
             return
             
         #Unknown state... shouldn't happen
         assert False
         
+    def runtime_state(self):
+        """Returns runtime state to be saved, None if the device isn't running"""
+        if self.state.__class__ not in (DSRunning, DSVerifying):
+            return None
+        return {'type': self.device_type, 'version': self.device_version, 'unknown': self.device_unknown_tuple,
+            'is_on': self.device_is_on, 'power': self.device_power, 'want_on': self.want_on}
+        
+    def restore_runtime_state(self, values, delay = 0):
+        """Restore state saved by runtime_state (as provisional state,
+        until the device answers), first probe is sent after delay"""
+        def to_tuple(v):
+            return tuple(v) if type(v) == list else v
+        
+        #Check everything before modifying the device
+        device_type = values['type']
+        device_version = to_tuple(values['version'])
+        device_unknown_tuple = to_tuple(values['unknown'])
+        device_is_on = values['is_on']
+        device_power = values['power']
+        want_on = values['want_on']
+        if device_is_on not in (True, False, None) or want_on not in (True, False, None):
+            raise ValueError("Invalid on/off state")
+        if device_power is not None:
+            device_power = float(device_power)
+        
+        self.device_type = device_type
+        self.device_version = device_version
+        self.device_unknown_tuple = device_unknown_tuple
+        self.device_is_on = device_is_on
+        self.device_power = device_power
+        self.want_on = want_on
+        self.state = DSVerifying(last_sent = time.time(), num_sent = 0, delay = delay)
+        
+    def pib_progress(self):
+        """Returns (offset, size) of the PIB transfer, None if not in a PIB state"""
+        if self.state.__class__ == DSReadPIB:
+            return (len(self.state.pib), self.state.pib.size())
+        if self.state.__class__ == DSWritePIB:
+            return (self.state.pib_current_offset, len(self.state.pib))
+        if self.state.__class__ == DSWritePIBToNVM:
+            return (len(self.state.pib), len(self.state.pib))
+        return None
+        
+    def jitter(self, delay):
+        """Randomize delay by +/- probe_jitter, so that devices don't send
+        their probes at the same time"""
+        return delay * random.uniform(1 - self.probe_jitter, 1 + self.probe_jitter)
+        
+    def probe_backoff_delay(self, num_sent):
+        """Delay before next probe in DSProbingHP state"""
+        return self.jitter(min(self.probe_delay * self.probe_backoff ** num_sent, self.probe_max_delay))
+        
     def packet_homeplug(self, action, data):
         #Do we expect HomePlugAV packets?
         if self.state.__class__ not in (DSProbingHP, DSReadPIB, DSWritePIB, DSWritePIBToNVM):
@@ -170,6 +419,7 @@ class Device:
             
         #PIB written successfully to NVM
         if self.state.__class__ == DSWritePIBToNVM:
+            self.server._provisioning.release(self.remote_mac, True)
             self.reset_state()
             return True
             
@@ -177,11 +427,11 @@ class Device:
             #Last chunk?
             if self.state.pib_current_offset + self.pib_chunk >= len(self.state.pib):
                 #Write to NVM
-                self.state = DSWritePIBToNVM(start_time = time.time(), last_sent = 0)
+                self.state = DSWritePIBToNVM(start_time = time.time(), last_sent = 0, pib = self.state.pib)
                 return True
                 
             #Next chunk
-            self.state = DSWritePIB(start_time = self.state.start_time, last_sent = 0, pib_current_offset = self.state.pib_current_offset + self.pib_chunk, pib = self.state.pib)
+            self.state = DSWritePIB(start_time = time.time(), last_sent = 0, pib_current_offset = self.state.pib_current_offset + self.pib_chunk, pib = self.state.pib)
             return True
             
         if self.state.__class__ in (DSProbingHP, DSReadPIB):
@@ -201,6 +451,32 @@ class Device:
                 if offset != 0: #In state probing, and not the beginning of the PIB
                     return False
                 
+                #Only a limited number of devices may be provisioned at the same time
+                if not self.server._provisioning.request(self.remote_mac, self.priority):
+                    #Device is reachable, probe again to get a slot, with
+                    #backoff while slots stay busy
+                    self.slot_refused += 1
+                    delay = min(self.probe_delay * self.probe_backoff ** min(self.slot_refused - 1, 16), self.slot_max_delay)
+                    self.state = DSProbingHP(last_sent = time.time(), num_sent = 0, delay = self.jitter(delay))
+                    return False
+                self.slot_refused = 0
+                
+                resume = self.pib_resume
+                self.pib_resume = None
+                
+                #Resume if the beginning of the PIB is what we read/wrote
+                #(the device wasn't restarted in between)
+                if resume is not None and resume.pib[0:len(data)] == data:
+                    if resume.__class__ == DSReadPIB:
+                        self.state = DSReadPIB(start_time = time.time(), last_sent = 0, pib = resume.pib)
+                        return True
+                    if resume.__class__ == DSWritePIB and resume.pib_current_offset > 0:
+                        self.state = DSWritePIB(start_time = time.time(), last_sent = 0, pib_current_offset = resume.pib_current_offset, pib = resume.pib)
+                        return True
+                    if resume.__class__ == DSWritePIBToNVM:
+                        self.state = DSWritePIBToNVM(start_time = time.time(), last_sent = 0, pib = resume.pib)
+                        return True
+                
                 #Read PIB
                 self.state = DSReadPIB(start_time = time.time(), last_sent = 0, pib=PIB(data))
                 
@@ -216,6 +492,7 @@ class Device:
                 if newpib.is_complete():
                     if not newpib.is_valid():
                         #Wrong checksum, reset everything
+                        self.server._provisioning.release(self.remote_mac, False)
                         self.reset_state()
                         return
                     
@@ -233,7 +510,7 @@ class Device:
                     
                 else:
                     #PIB is not complete, read next packet
-                    self.state = DSReadPIB(start_time = self.state.start_time, last_sent = 0, pib=newpib)
+                    self.state = DSReadPIB(start_time = time.time(), last_sent = 0, pib=newpib)
                     
                     
                 
@@ -243,7 +520,7 @@ class Device:
         if len(data) < 4:
             return False
             
-        if self.state.__class__ not in (DSProbing, DSProbingHP, DSRunning):
+        if self.state.__class__ not in (DSProbing, DSProbingHP, DSVerifying, DSRunning):
             return False
             
         #Packet consists of multiple 64-bytes chunks, length is data[1].
@@ -265,9 +542,17 @@ class Device:
             mdata_length = mdata[1]
             mdata_message = mdata[2:2+mdata_length]
             
+            self.match_reply(mdata_function)
+                
             #1 = power information
             if mdata_function == 1:
-                self.receive_powerdata(mdata_message.decode('ascii').strip())
+                powerdata = parse_powerdata(mdata_message)
+                if powerdata is None:
+                    #Malformed message, ignore it
+                    hexdata = ":".join(['{0:02X}'.format(x) for x in mdata])
+                    print(self.remote_mac, "malformed power information", hexdata)
+                    continue
+                self.receive_powerdata(powerdata)
                 self.state = DSRunning(last_sent = self.state.last_sent, last_received = time.time())
                 continue
                 
@@ -275,7 +560,8 @@ class Device:
             #12 = unsollicited
             if mdata_function in (9, 12):
                 #On/Off information (in first byte)
-                assert(mdata_length==1)
+                if mdata_length != 1:
+                    continue
                 
                 mdata_state = mdata_message[0]
                 
@@ -290,34 +576,89 @@ class Device:
             hexdata = ":".join(['{0:02X}'.format(x) for x in data])
             print(self.remote_mac, "ether", hexdata)
         
+    def queue_ether_probe(self):
+        self.ether_queue.append(EtherProbe)
+        
+    def queue_ether_on(self):
+        self.device_is_on = None
+        self.ether_queue.append(EtherOn)
+        
+    def queue_ether_off(self):
+        self.device_is_on = None
+        self.ether_queue.append(EtherOff)
+        
+    def flush_ether(self):
+        """Send queued ethernet messages, packed in as few frames as
+        possible if coalesce is enabled"""
+        if len(self.ether_queue) == 0:
+            return
+        
+        self.expire_pending_frames()
+        
+        queue = self.ether_queue
+        self.ether_queue = []
+        
+        if self.coalesce:
+            frames = [queue[i:i+EtherMaxChunks] for i in range(0, len(queue), EtherMaxChunks)]
+        else:
+            frames = [[x] for x in queue]
+            
+        for chunks in frames:
+            msg = b'\x00' + struct.pack('<B', 64*len(chunks)) + b''.join(chunks)
+            self.server._send_to_device(self, msg)
+            
+            #Replies we expect, if several messages were sent in one frame
+            if len(chunks) > 1:
+                self.pending_frames.append([time.time(), [EtherReplies[x[0]] for x in chunks], 0])
+        
+    def match_reply(self, function):
+        """Match a reply with the oldest coalesced frame expecting it"""
+        for frame in self.pending_frames:
+            if function in frame[1]:
+                frame[1].remove(function)
+                frame[2] += 1
+                if len(frame[1]) == 0:
+                    #All replies received
+                    self.pending_frames.remove(frame)
+                    self.partial_replies = 0
+                return
+        
+    def expire_pending_frames(self):
+        """Check coalesced frames whose replies didn't all arrive in time"""
+        now = time.time()
+        pending_frames = []
+        for frame in self.pending_frames:
+            if frame[0] >= now - self.reply_timeout:
+                pending_frames.append(frame)
+            elif frame[2] > 0:
+                #Only some replies were received (if none, the frame
+                #was probably lost, which tells nothing)
+                self.partial_replies += 1
+        self.pending_frames = pending_frames
+        
+        #The device seems to ignore the additional chunks
+        if self.coalesce and self.partial_replies >= self.max_partial_replies:
+            print(self.remote_mac, "doesn't support coalesced frames")
+            self.coalesce = False
+            self.pending_frames = []
+        
     def send_ether_probe(self):
-        msg = b'\x00\x40' + b'\x00\x00\x00' + b'\x00'*60 + b'\x01'
-        self.server._send_to_device(self, msg)
+        self.queue_ether_probe()
+        self.flush_ether()
         
     def send_ether_on(self):
-        self.device_is_on = None
-        msg = b'\x00\x40' + b'\x08\x01\x01' + b'\x00'*60 + b'\x00'
-        self.server._send_to_device(self, msg)
+        self.queue_ether_on()
+        self.flush_ether()
         
     def send_ether_off(self):
-        self.device_is_on = None
-        msg = b'\x00\x40' + b'\x08\x01\x00' + b'\x00'*60 + b'\x01'
-        self.server._send_to_device(self, msg)
+        self.queue_ether_off()
+        self.flush_ether()
         
     def send_hp_probe(self):
         self.send_hp_read_pib(0, self.pib_chunk)
         
     def send_hp_read_pib(self, offset, length):
-        msg = b'\x88\xe1' #HomePlug AV
-        msg += b'\x00' #v1.0
-        msg += struct.pack('<H',0xa024) #Read Module Data Request
-        msg += b'\x00\xb0\x52' #Vendor MME OUI
-        msg += b'\x02' #Module ID: PIB
-        msg += b'\x00' #Reserved
-        msg += struct.pack('<H',length)
-        msg += struct.pack('<I',offset)
-        
-        self.server._send_to_device(self, msg)
+        self.server._send_to_device(self, hp_read_pib_request(offset, length))
         
     def send_hp_write_pib(self):
         assert(self.state.__class__ == DSWritePIB)
@@ -348,50 +689,72 @@ class Device:
         
         self.server._send_to_device(self, msg)
         
-    def receive_powerdata(self, data):
-        parts = data.split(';')
-        assert(parts[0] in ('2','3'))
-        assert(parts[3] in ('0','1'))
-        
-        device_type = parts[0]
-        device_is_on = (parts[3] == '1')
-        device_power = float(parts[4])
-        
-        if device_type == '2':
-            #Blue device
-            device_unknown_tuple = (parts[1], parts[5], parts[6])
-            device_version = (parts[2], parts[7])
-            pass
-        elif device_type == '3':
-            #White device
-            device_unknown_tuple = (parts[1])
-            device_version = (parts[2], )
-            pass
-            
-        if self.device_unknown_tuple is None:
-            self.device_unknown_tuple = device_unknown_tuple
-        if self.device_version is None:
-            self.device_version = device_version
-        if self.device_type is None:
-            self.device_type = device_type
-            
-        assert(self.device_unknown_tuple == device_unknown_tuple)
-        assert(self.device_version == device_version)
-        assert(self.device_type == device_type)
+    def receive_powerdata(self, powerdata):
+        """Handle a PowerData record (see parse_powerdata)"""
+        self.device_type = powerdata.device_type
+        self.device_version = powerdata.version
+        self.device_unknown_tuple = powerdata.unknown
+        
+        device_power = powerdata.power
+        device_is_on = powerdata.is_on
+        
+        self.update_poll_interval(device_power, device_is_on)
         
         self.device_power = device_power
         self.device_is_on = device_is_on
-         
+        
+        now = time.time()
+        #Same reading as the last logged one (within deadband): don't log it
+        same = False
+        if self.last_logged is not None:
+            last_time, last_is_on, last_power = self.last_logged
+            same = (last_is_on == device_is_on and abs(last_power - device_power) <= self.deadband)
+            if same and now - last_time < self.report_max_interval:
+                self.suppressed = (now, device_is_on, device_power)
+                self.server.report_data(self, self.device_is_on, self.device_power, log = False)
+                return
+        
+        if same:
+            #Periodic record of a steady reading
+            self.suppressed = None
+        else:
+            self.flush_suppressed()
+        self.last_logged = (now, device_is_on, device_power)
         self.server.report_data(self, self.device_is_on, self.device_power)
         
+    def flush_suppressed(self):
+        """Log the last reading which wasn't logged, so that the power
+        change is correctly placed in time"""
+        if self.suppressed is None:
+            return
+        t, is_on, power = self.suppressed
+        self.suppressed = None
+        self.server.log_data(self, is_on, power, t)
+        
+    def update_poll_interval(self, device_power, device_is_on):
+        """Adaptive polling: back off while power is stable, snap back to
+        interval if it changed, or if a switch is pending"""
+        if self.interval_max is None:
+            return
+        
+        stable = (self.device_power is not None and abs(device_power - self.device_power) <= self.tolerance and self.device_is_on == device_is_on)
+        
+        if stable and self.want_on is None:
+            self.poll_interval = min(self.poll_interval * self.interval_backoff, self.interval_max)
+        else:
+            self.poll_interval = self.interval
+        
     def receive_is_on(self):
         #Set want_on to null if we reached the target state
         if self.want_on is not None:
             if self.want_on:
                 self.want_on = None
                 
+        if self.device_is_on is not True:
+            self.poll_interval = self.interval
         self.device_is_on = True
         
+        self.flush_suppressed()
         self.server.report_data(self, self.device_is_on, None)
         
     def receive_is_off(self):
@@ -400,16 +763,21 @@ class Device:
             if not self.want_on:
                 self.want_on = None
                 
+        if self.device_is_on is not False:
+            self.poll_interval = self.interval
         self.device_is_on = False
+        self.flush_suppressed()
         self.server.report_data(self, self.device_is_on, None)
         
 
     def on(self):
         self.want_on = True
+        self.poll_interval = self.interval
         return
         
     def off(self):
         self.want_on = False
+        self.poll_interval = self.interval
         return
         
     def calc_cksum(self, data):
@@ -0,0 +1,179 @@
+import math
+
+import numpy
+
+#Raw samples, as reported by the device
+#is_on: 1 = on, 0 = off, -1 = unknown ; power is NaN if unknown
+RAW_DTYPE = numpy.dtype([('time', 'f8'), ('is_on', 'i1'), ('power', 'f4')])
+
+#Downsampled samples, one per period
+#time is the start of the period, energy is in Wh
+TIER_DTYPE = numpy.dtype([('time', 'f8'), ('min', 'f4'), ('max', 'f4'), ('avg', 'f4'), ('energy', 'f8'), ('count', 'u4')])
+
+class Ring:
+    """Fixed-size ring buffer backed by a numpy structured array"""
+    _data = None
+    #Index of the next slot to write
+    _pos = 0
+    #Number of valid entries
+    _count = 0
+
+    def __init__(self, dtype, capacity):
+        assert(capacity > 0)
+        self._data = numpy.zeros(capacity, dtype = dtype)
+        self._pos = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def capacity(self):
+        return len(self._data)
+
+    def nbytes(self):
+        return self._data.nbytes
+
+    def append(self, values):
+        """Append a tuple of values, overwriting the oldest one if full"""
+        self._data[self._pos] = values
+        self._pos = (self._pos + 1) % len(self._data)
+        self._count = min(self._count + 1, len(self._data))
+
+    def get(self, since = None, until = None):
+        """Returns a chronological copy of the entries with since <= time < until"""
+        if self._count < len(self._data):
+            data = self._data[:self._count]
+        else:
+            data = numpy.concatenate((self._data[self._pos:], self._data[:self._pos]))
+
+        #Entries are appended in chronological order, so we can bisect
+        start = 0
+        end = len(data)
+        if since is not None:
+            start = numpy.searchsorted(data['time'], since, side = 'left')
+        if until is not None:
+            end = numpy.searchsorted(data['time'], until, side = 'left')
+
+        return data[start:end].copy()
+
+class Tier:
+    """Downsampling of power samples in fixed periods (min/max/avg/energy)"""
+    period = None
+    ring = None
+
+    #Current (not yet complete) period
+    _bucket = None
+    _min = None
+    _max = None
+    _sum = 0.
+    _count = 0
+    _energy = 0.
+
+    def __init__(self, period, capacity):
+        self.period = period
+        self.ring = Ring(TIER_DTYPE, capacity)
+        self._bucket = None
+
+    def add(self, t, power, energy):
+        """Add a power sample (W) at time t, and the energy (Wh) since the previous sample"""
+        bucket = math.floor(t / self.period)
+        if bucket != self._bucket:
+            self.flush()
+            self._bucket = bucket
+            self._min = power
+            self._max = power
+            self._sum = 0.
+            self._count = 0
+            self._energy = 0.
+
+        self._min = min(self._min, power)
+        self._max = max(self._max, power)
+        self._sum += power
+        self._count += 1
+        self._energy += energy
+
+    def flush(self):
+        """Store the current period in the ring"""
+        if self._bucket is None or self._count == 0:
+            return
+        self.ring.append((self._bucket * self.period, self._min, self._max, self._sum / self._count, self._energy, self._count))
+        self._bucket = None
+
+    def get(self, since = None, until = None):
+        """Returns the complete periods, and the current one if any"""
+        data = self.ring.get(since, until)
+        if self._bucket is None or self._count == 0:
+            return data
+
+        start = self._bucket * self.period
+        if (since is not None and start < since) or (until is not None and start >= until):
+            return data
+        current = numpy.array([(start, self._min, self._max, self._sum / self._count, self._energy, self._count)], dtype = TIER_DTYPE)
+        return numpy.concatenate((data, current))
+
+class DeviceHistory:
+    """In-memory history of a device: raw samples plus downsampled tiers.
+    Memory is allocated once, and doesn't grow with uptime."""
+    raw = None
+    #Map: <period in seconds> => Tier
+    tiers = None
+    #Don't integrate energy over gaps longer than this (s)
+    max_gap = None
+
+    #Last power sample (time, power) for energy integration
+    _last = None
+
+    def __init__(self, raw_capacity, tiers, max_gap = 300):
+        """tiers is a list of (period, capacity)"""
+        self.raw = Ring(RAW_DTYPE, raw_capacity)
+        self.tiers = dict([(period, Tier(period, capacity)) for period, capacity in tiers])
+        self.max_gap = max_gap
+        self._last = None
+
+    def nbytes(self):
+        """Memory used by the buffers"""
+        return self.raw.nbytes() + sum([x.ring.nbytes() for x in self.tiers.values()])
+
+    def append(self, t, is_on, power):
+        """Record a sample, is_on and/or power may be None"""
+        self.raw.append((t, {True: 1, False: 0, None: -1}[is_on], numpy.nan if power is None else power))
+
+        if power is None:
+            return
+
+        #Trapezoidal integration since the last power sample
+        energy = 0.
+        if self._last is not None:
+            last_t, last_power = self._last
+            dt = t - last_t
+            if 0 < dt <= self.max_gap:
+                energy = (last_power + power) / 2. * dt / 3600.
+        self._last = (t, power)
+
+        for tier in self.tiers.values():
+            tier.add(t, power, energy)
+
+    def get(self, since = None, until = None, period = None):
+        """Returns raw samples if period is None, otherwise the downsampled
+        tier for this period (see RAW_DTYPE and TIER_DTYPE)"""
+        if period is None:
+            return self.raw.get(since, until)
+
+        if period not in self.tiers:
+            raise ValueError("Invalid history period {0}!".format(period))
+        return self.tiers[period].get(since, until)
+
+def history_nbytes(raw_capacity, tiers):
+    """Memory used by the buffers of a DeviceHistory"""
+    return RAW_DTYPE.itemsize * raw_capacity + TIER_DTYPE.itemsize * sum([capacity for period, capacity in tiers])
+
+def parse_tiers(value):
+    """Parse a comma separated list of period:capacity"""
+    tiers = []
+    for item in value.split(','):
+        item = item.strip()
+        if item == '':
+            continue
+        period, capacity = item.split(':')
+        tiers.append((int(period), int(capacity)))
+    return tiers
@@ -0,0 +1,100 @@
+import time
+
+class ProvisioningScheduler:
+    """Limit the number of devices in PIB states (read, write, write to
+    NVM), and the rate of PIB data sent/requested on the powerline.
+
+    Devices ask for a slot with request(), the best waiting device (higher
+    priority first, then first come) gets the next free slot."""
+    #Maximum number of devices in PIB states (0 = unlimited)
+    max_active = 4
+    #Budget of PIB bytes per second (0 = unlimited)
+    byte_rate = 0
+    #Waiting devices which didn't ask for a slot since stale_time are ignored
+    stale_time = 60
+
+    #Map: <mac> => admission time
+    _active = None
+    #Map: <mac> => (priority, first request, last request)
+    _waiting = None
+
+    #Token bucket for byte_rate
+    _tokens = 0.
+    _last_refill = None
+
+    #Statistics
+    completed = 0
+    aborted = 0
+    bytes_sent = 0
+
+    def __init__(self):
+        self._active = {}
+        self._waiting = {}
+        self._tokens = 0.
+        self._last_refill = time.time()
+
+    def configure(self, max_active, byte_rate):
+        self.max_active = max_active
+        self.byte_rate = byte_rate
+
+    def request(self, mac, priority = 0):
+        """Ask for a slot, returns True if mac may enter PIB states"""
+        now = time.time()
+        if mac in self._active:
+            return True
+
+        first = self._waiting[mac][1] if mac in self._waiting else now
+        self._waiting[mac] = (priority, first, now)
+
+        if self.max_active > 0 and len(self._active) >= self.max_active:
+            return False
+
+        #Is there a better device waiting?
+        for other, (other_priority, other_first, other_last) in self._waiting.items():
+            if other == mac or other_last < now - self.stale_time:
+                continue
+            if (-other_priority, other_first) < (-priority, first):
+                return False
+
+        del self._waiting[mac]
+        self._active[mac] = now
+        return True
+
+    def release(self, mac, success = None):
+        """mac left PIB states: success is True if the PIB was written, False
+        if aborted, None otherwise (e.g. no need to write)"""
+        self._waiting.pop(mac, None)
+        if mac not in self._active:
+            return
+        del self._active[mac]
+
+        if success is True:
+            self.completed += 1
+        elif success is False:
+            self.aborted += 1
+
+    def consume(self, nbytes):
+        """Returns True if nbytes of PIB data may be sent now"""
+        if self.byte_rate <= 0:
+            self.bytes_sent += nbytes
+            return True
+
+        now = time.time()
+        #Allow bursts of one second, but at least one chunk
+        capacity = max(self.byte_rate, nbytes)
+        self._tokens = min(capacity, self._tokens + (now - self._last_refill) * self.byte_rate)
+        self._last_refill = now
+
+        if self._tokens < nbytes:
+            return False
+        self._tokens -= nbytes
+        self.bytes_sent += nbytes
+        return True
+
+    def is_active(self, mac):
+        return mac in self._active
+
+    def waiting(self):
+        """Number of (non-stale) waiting devices"""
+        now = time.time()
+        return len([x for x in self._waiting.values() if x[2] >= now - self.stale_time])
@@ -6,16 +6,26 @@ import os
 import select
 import time
 import struct
+import json
 
-from configparser import ConfigParser
+from configparser import ConfigParser, Error as ConfigParserError
 
-from asokapy.device import Device
+from asokapy.device import Device, EtherProbe, EtherDeviceFunctions, hp_read_pib_request
+from asokapy.provisioning import ProvisioningScheduler
+
+#History is optional, it requires numpy
+try:
+    from asokapy.history import DeviceHistory, history_nbytes, parse_tiers
+except ImportError:
+    DeviceHistory = None
 
 class Server(threading.Thread):
     #Configparser of current config file
     _config = None
     #File name of config file
     _config_file = None
+    #Map: <section> => dict of values, of current config (to compute changes on reload)
+    _config_sections = {}
     
     #Interface
     _interface = None
@@ -28,8 +38,26 @@ class Server(threading.Thread):
     _uid = None
     _gid = None
     
-    #File handle of data log file
+    #File handle of data log file, and its file name
     _datalog = None
+    _datalog_filename = None
+    
+    #In-memory history settings (raw capacity, list of (period, capacity))
+    #History is disabled if _history_size is 0
+    _history_size = 0
+    _history_tiers = []
+    #Memory budget for the history of all devices, and memory allocated
+    #(history is allocated on first reading, while the budget allows it)
+    _history_max_bytes = 0
+    _history_bytes = 0
+    
+    #File where device runtime state is saved (warm restart), and save interval
+    _state_file = None
+    _state_save_interval = 60
+    #Pending switch commands (want_on) older than this (s) are not restored
+    _state_max_age = 3600
+    #Timestamp of the last save of runtime state
+    _last_state_save = None
     
     #RAW socket
     _sock = None
@@ -47,10 +75,32 @@ class Server(threading.Thread):
     #Interval between two ticks
     _tick_interval = 1
     
+    #Limits PIB rewrites (see asokapy.provisioning)
+    _provisioning = None
+    _provisioning_slots = 4
+    _provisioning_rate = 0
+    
+    #Discovery of devices by broadcast probes (see doc/sample_config.ini)
+    _discovery = False
+    _discovery_interval = 300
+    _discovery_template = 'template'
+    _discovery_oui = '00:13:c1'
+    _discovery_max = 1024
+    _discovery_inventory = None
+    _discovery_homeplug = False
+    #Timestamp of the last broadcast probe
+    _last_discovery = None
+    #Set of discovered devices mac address (not in config file)
+    _discovered = set()
+    #Was a device discovered since the inventory was saved?
+    _discovered_dirty = False
+    
     #Map: <mac address as bytes> => Device
     _devices = {}
     #List of devices mac address
     _devices_list = []
+    #Map: <mac address> => dict of values, config applied to each device
+    _devices_config = {}
     
     def __init__(self, config_file):
         threading.Thread.__init__(self)
@@ -61,13 +111,21 @@ class Server(threading.Thread):
         self._last_tick = 0
         self._lock_config = threading.RLock()
         self._lock_status = threading.RLock()
+        self._provisioning = ProvisioningScheduler()
         
         #Will be populated by reload
+        self._config_sections = {}
         self._devices = {}
         self._devices_list = []
+        self._devices_config = {}
+        self._discovered = set()
         
-        #(Re)load config and start thread
-        self.reload()
+        #Load config, restore state of previous run and start thread
+        #(the server stops at once if the initial config is invalid)
+        if self.reload() is False:
+            self._continue = False
+        else:
+            self._restore_state()
         self.start()
         
     def run(self):
@@ -110,6 +168,7 @@ class Server(threading.Thread):
         finally:
             #If we exit the main loop, obviously we're not running
             self._continue = False
+            self.save_state()
     
     def stop(self):
         """Stop the main loop"""
@@ -119,69 +178,285 @@ class Server(threading.Thread):
         """Is the server running?"""
         return self._continue
              
-    def _reload(self):
-        """Reload configuration"""
-        self._config = ConfigParser()
-        self._config.read([self._config_file])
-        
-        if self._interface != self._config.get('master','interface'):
-            if self._sock is not None:
-                self._sock.close()
-                self._sock = None
-            
-            self._interface = self._config.get('master','interface')
-            self._sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.ntohs(0x0003))
-            self._sock.bind((self._interface, 0))
-            
-        self._interface_mac = self._config.get('master','mac')
-        self._interface_mac_bytes = self._to_bytes(self._interface_mac)
+    def _read_config(self):
+        """Parse the config file, returns (ConfigParser, map: <section> => dict of values)"""
+        config = ConfigParser()
+        config.read([self._config_file])
+        sections = dict([(x, dict(config.items(x))) for x in config.sections()])
+        return config, sections
+        
+    def _parse_master(self, values):
+        """Parse and check settings of master section, returns a map:
+        <attribute> => value (raises an exception if invalid)"""
+        settings = {}
+        settings['_interface'] = values['interface']
+        settings['_interface_mac'] = values['mac']
+        settings['_interface_mac_bytes'] = self._to_bytes(values['mac'])
+        
+        settings['_uid'] = int(values['uid']) if 'uid' in values else None
+        settings['_gid'] = int(values['gid']) if 'gid' in values else None
+        
+        settings['_datalog_filename'] = values.get('datalog')
+        
+        settings['_provisioning_slots'] = int(values.get('provisioning_slots', 4))
+        settings['_provisioning_rate'] = int(values.get('provisioning_rate', 0))
+        
+        settings['_discovery'] = values.get('discovery', '0').lower() in ('1', 'yes', 'true', 'on')
+        settings['_discovery_interval'] = int(values.get('discovery_interval', 300))
+        settings['_discovery_template'] = values.get('discovery_template', 'template')
+        settings['_discovery_oui'] = values.get('discovery_oui', '00:13:c1').lower()
+        settings['_discovery_max'] = int(values.get('discovery_max', 1024))
+        settings['_discovery_inventory'] = values.get('discovery_inventory')
+        settings['_discovery_homeplug'] = values.get('discovery_homeplug', '0').lower() in ('1', 'yes', 'true', 'on')
+        
+        settings['_state_file'] = values.get('statefile')
+        settings['_state_save_interval'] = int(values.get('statefile_interval', 60))
+        settings['_state_max_age'] = int(values.get('statefile_max_age', 3600))
         
-        self._uid = self._config.getint('master','uid', fallback = None)
-        self._gid = self._config.getint('master','gid', fallback = None)
+        if DeviceHistory is not None:
+            settings['_history_size'] = int(values.get('history_size', 3600))
+            settings['_history_tiers'] = parse_tiers(values.get('history_tiers', '60:1440,900:2880'))
+            settings['_history_max_bytes'] = int(values.get('history_max_bytes', 64 * 1024 * 1024))
+        else:
+            settings['_history_size'] = 0
+            settings['_history_tiers'] = []
+        return settings
+        
+    def _reload_master(self, settings):
+        """Apply settings returned by _parse_master, keep socket and
+        datalog if their settings didn't change. New handles are opened
+        before the old ones are closed, so that a failure keeps them."""
+        sock = self._sock
+        if self._interface != settings['_interface']:
+            sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.ntohs(0x0003))
+            sock.bind((settings['_interface'], 0))
         
-        if self._gid is not None:
-            os.setgid(self._gid)
-            os.setegid(self._gid)
+        try:
+            gid = settings['_gid']
+            if gid is not None and (os.getgid() != gid or os.getegid() != gid):
+                os.setgid(gid)
+                os.setegid(gid)
+                
+            uid = settings['_uid']
+            if uid is not None and (os.getuid() != uid or os.geteuid() != uid):
+                os.setuid(uid)
+                os.seteuid(uid)
             
-        if self._uid is not None:
-            os.setuid(self._uid)
-            os.seteuid(self._uid)
+            datalog = self._datalog
+            datalogfilename = settings['_datalog_filename']
+            if datalogfilename != self._datalog_filename or (datalogfilename is not None and self._datalog is None):
+                datalog = open(datalogfilename, 'a') if datalogfilename is not None else None
+        except:
+            if sock is not self._sock:
+                sock.close()
+            raise
         
-        if self._datalog is not None:
+        if sock is not self._sock and self._sock is not None:
+            self._sock.close()
+        if datalog is not self._datalog and self._datalog is not None:
             self._datalog.close()
-            self._datalog = None
+        self._sock = sock
+        self._datalog = datalog
+        
+        for k, v in settings.items():
+            setattr(self, k, v)
+        
+        self._provisioning.configure(self._provisioning_slots, self._provisioning_rate)
+        
+    def _reload(self, config = None):
+        """Reload configuration: only the sections which changed are applied,
+        devices whose section didn't change keep their state"""
+        if config is None:
+            config = self._read_config()
+        new_config, new_sections = config
+        old_sections = self._config_sections
+        
+        new_devices_list = [x for x in new_config.sections() if ':' in x]
+        new_devices_config = dict([(x, new_sections[x]) for x in new_devices_list])
+        
+        master_changed = (old_sections.get('master') != new_sections['master'])
+        
+        #Parse and check everything before modifying anything
+        master_settings = self._parse_master(new_sections['master'])
+        
+        #Discovered devices (not in config file) use the template section
+        if master_settings['_discovery']:
+            template = new_sections.get(master_settings['_discovery_template'], {})
+            #Check it now, devices discovered later get it as is
+            Device(self, master_settings['_discovery_template']).parse_config(template)
+            configured = set([self._to_bytes(x) for x in new_devices_list])
+            inventory = self._read_inventory(master_settings['_discovery_inventory'])
+            #Devices discovered during this run come first
+            num_discovered = 0
+            for d in sorted(self._discovered) + sorted(inventory.difference(self._discovered)):
+                if num_discovered >= master_settings['_discovery_max']:
+                    break
+                try:
+                    dev_mac_bytes = self._to_bytes(d)
+                except ValueError:
+                    #Malformed inventory entry
+                    continue
+                if len(dev_mac_bytes) != 6 or dev_mac_bytes in configured:
+                    continue
+                d = self._to_comma_separated(dev_mac_bytes)
+                if not d.startswith(master_settings['_discovery_oui']):
+                    continue
+                configured.add(dev_mac_bytes)
+                new_devices_list.append(d)
+                new_devices_config[d] = template
+                num_discovered += 1
         
-        datalogfilename = self._config.get('master','datalog', fallback = None)
-        if datalogfilename is not None:
-            self._datalog = open(datalogfilename, 'a')
-
-
-            
-        new_devices_list = [x for x in self._config.sections() if ':' in x]
         new_devices_set = set(new_devices_list)
         old_devices_set = set(self._devices_list)
         
         devices_to_add = new_devices_set.difference(old_devices_set)
         devices_to_remove = old_devices_set.difference(new_devices_set)
+        devices_to_update = [d for d in new_devices_list if d in devices_to_add or self._devices_config.get(d) != new_devices_config[d]]
+        
+        #Spread the first probes of new devices over probe_delay
+        new_devices = {}
+        for i, d in enumerate(sorted(devices_to_add)):
+            device = Device(self, d)
+            device.reset_state(i * device.probe_delay / len(devices_to_add))
+            new_devices[self._to_bytes(d)] = device
         
-        for d in devices_to_add:
-            self._devices[self._to_bytes(d)] = Device(self, d)
+        devices_config = {}
+        for d in devices_to_update:
+            device = new_devices.get(self._to_bytes(d)) or self._devices[self._to_bytes(d)]
+            devices_config[d] = device.parse_config(new_devices_config[d])
+        
+        #Apply changes while the main loop doesn't run
+        self._lock_status.acquire()
+        try:
+            if master_changed:
+                self._reload_master(master_settings)
             
-        for d in devices_to_remove:
-            del self._devices[self._to_bytes(d)]
+            for d in devices_to_remove:
+                self._provisioning.release(d)
+                self._free_history(self._devices[self._to_bytes(d)])
+                del self._devices[self._to_bytes(d)]
+                
+            self._devices.update(new_devices)
             
-        for d in new_devices_list:
-            self._devices[self._to_bytes(d)].update_config(dict(self._config.items(d)))
-        
-        self._devices_list = new_devices_list
+            for d in devices_to_update:
+                self._devices[self._to_bytes(d)].apply_config(devices_config[d])
             
+            #History settings may have changed for every device
+            for d in (new_devices_list if master_changed else devices_to_update):
+                self._update_history(self._devices[self._to_bytes(d)])
+            
+            self._devices_list = new_devices_list
+            self._devices_config = new_devices_config
+            self._discovered = set([d for d in new_devices_list if d not in new_sections])
+            self._config = new_config
+            self._config_sections = new_sections
+        finally:
+            self._lock_status.release()
+            
+    def _read_inventory(self, filename):
+        """Returns the set of devices saved in the discovery inventory"""
+        if filename is None or not os.path.exists(filename):
+            return set()
+        inventory = ConfigParser()
+        try:
+            inventory.read([filename])
+        except ConfigParserError as e:
+            print("Ignoring discovery inventory", filename, e)
+            return set()
+        return set([x.lower() for x in inventory.sections() if ':' in x])
+        
+    def _save_inventory(self):
+        """Save discovered devices (one section per device)"""
+        #Cleared even if saving fails, so that a bad path isn't retried
+        #every tick: it is saved again on the next discovery
+        self._discovered_dirty = False
+        if self._discovery_inventory is None:
+            return
+        
+        tmp_filename = self._discovery_inventory + '.tmp'
+        try:
+            with open(tmp_filename, 'w') as f:
+                for d in sorted(self._discovered):
+                    f.write('[{0}]\n'.format(d))
+            os.replace(tmp_filename, self._discovery_inventory)
+        except OSError as e:
+            #Don't stop the server (e.g. permissions after setuid, disk full)
+            print("Cannot save discovery inventory to", self._discovery_inventory, e)
+        
+    def _discover(self, dev_mac_bytes):
+        """A device which isn't in the config answered, create it if
+        discovery is enabled. Returns the device, or None"""
+        if not self._discovery:
+            return None
+        
+        dev_mac = self._to_comma_separated(dev_mac_bytes)
+        if not dev_mac.startswith(self._discovery_oui):
+            return None
+        if len(self._discovered) >= self._discovery_max:
+            return None
+        
+        template = self._config_sections.get(self._discovery_template, {})
+        device = Device(self, dev_mac)
+        device.update_config(template)
+        self._update_history(device)
+        
+        self._devices[dev_mac_bytes] = device
+        self._devices_list.append(dev_mac)
+        self._devices_config[dev_mac] = template
+        self._discovered.add(dev_mac)
+        self._discovered_dirty = True
+        return device
+        
+    def _send_discovery(self):
+        """Broadcast ethernet and HomePlugAV probes"""
+        self._last_discovery = time.time()
+        broadcast = b'\xff'*6 + self._interface_mac_bytes
+        self._sock.send(broadcast + b'\x00\x40' + EtherProbe)
+        if self._discovery_homeplug:
+            #Only the beginning of the PIB, we only want an answer
+            self._sock.send(broadcast + hp_read_pib_request(0, 64))
+        
+    def _update_history(self, device):
+        """Free the history of the device if the settings changed, it
+        will be allocated again on next reading"""
+        settings = (self._history_size, tuple(self._history_tiers))
+        if device.history is not None and device.history_settings != settings:
+            self._free_history(device)
+        
+    def _free_history(self, device):
+        if device.history is None:
+            return
+        self._history_bytes -= device.history.nbytes()
+        device.history = None
+        device.history_settings = None
+        
+    def _allocate_history(self, device):
+        """Allocate the history of the device, if the memory budget allows it"""
+        if self._history_size <= 0:
+            return
+        
+        if self._history_bytes + history_nbytes(self._history_size, self._history_tiers) > self._history_max_bytes:
+            return
+        
+        device.history = DeviceHistory(self._history_size, self._history_tiers)
+        device.history_settings = (self._history_size, tuple(self._history_tiers))
+        self._history_bytes += device.history.nbytes()
+        
     def reload(self):
-        """Reload configuration from file. Returns False if failed, and stops the server"""
+        """Reload configuration from file. Returns False if failed, the
+        running config is then kept"""
+        #Parse the config without blocking the main loop
+        try:
+            config = self._read_config()
+        except Exception as e:
+            print("Cannot read config", self._config_file, e)
+            return False
+        
         self._lock_config.acquire()
         try:
-            return self._reload()
-        except:
-            self._continue = False
+            return self._reload(config)
+        except Exception as e:
+            print("Invalid config, keeping the running one:", e)
             return False
         finally:
             self._lock_config.release()
@@ -190,6 +465,79 @@ class Server(threading.Thread):
         """Send tick event to each device"""
         for d in self._devices.values():
             d.tick()
+        
+        if self._discovery:
+            if self._last_discovery is None or time.time() - self._last_discovery >= self._discovery_interval:
+                self._send_discovery()
+            if self._discovered_dirty:
+                self._save_inventory()
+        
+        #Periodic save of runtime state
+        if self._last_state_save is None:
+            self._last_state_save = time.time()
+        if time.time() - self._last_state_save >= self._state_save_interval:
+            self._save_state()
+            
+    def _save_state(self):
+        """Save runtime state of running devices in the state file"""
+        self._last_state_save = time.time()
+        if self._state_file is None:
+            return
+        
+        devices = {}
+        for d in self._devices.values():
+            state = d.runtime_state()
+            if state is not None:
+                devices[d.remote_mac] = state
+        
+        tmp_filename = self._state_file + '.tmp'
+        try:
+            with open(tmp_filename, 'w') as f:
+                json.dump({'time': time.time(), 'devices': devices}, f, separators = (',', ':'))
+            os.replace(tmp_filename, self._state_file)
+        except OSError as e:
+            #Don't stop the server (e.g. permissions after setuid, disk full)
+            print("Cannot save state to", self._state_file, e)
+        
+    def save_state(self):
+        """Save runtime state of devices, to be restored on next start"""
+        self._lock_status.acquire()
+        try:
+            return self._save_state()
+        finally:
+            self._lock_status.release()
+            
+    def _restore_state(self):
+        """Restore runtime state saved by a previous run, devices are
+        verified with a probe before being considered running"""
+        if self._state_file is None or not os.path.exists(self._state_file):
+            return
+        
+        try:
+            with open(self._state_file, 'r') as f:
+                saved = json.load(f)
+            saved_time = float(saved['time'])
+            devices = sorted(saved['devices'].items())
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            #Corrupted state file, start from scratch
+            return
+        
+        #Switch commands are not wanted anymore after some time
+        too_old = (time.time() - saved_time > self._state_max_age)
+        
+        #Spread the first probes over probe_delay
+        for i, (mac, values) in enumerate(devices):
+            try:
+                mac_bytes = self._to_bytes(mac)
+                if mac_bytes not in self._devices:
+                    continue
+                d = self._devices[mac_bytes]
+                if too_old:
+                    values = dict(values, want_on = None)
+                d.restore_runtime_state(values, i * d.probe_delay / len(devices))
+            except (ValueError, KeyError, TypeError, AssertionError):
+                #Corrupted entry, this device starts from scratch
+                continue
     
     def _handle_packet(self, recvdata):
         """Handle an incoming ethernet packet, and forward it to the
@@ -197,12 +545,6 @@ class Server(threading.Thread):
         if recvdata[0:6] != self._interface_mac_bytes:
             #Not for me
             return False
-        if recvdata[6:12] not in self._devices:
-            #Not from a known device
-            return False
-            
-        device = self._devices[recvdata[6:12]]
-        
         if recvdata[12:14] == b'\x88\xe1':
             #HomePlugAV
             if recvdata[14:15] != b'\x00': #reserved
@@ -211,7 +553,26 @@ class Server(threading.Thread):
             if recvdata[17:20] != b'\x00\xb0\x52':
                 #Bad MME OUI
                 return False
-            
+        elif len(recvdata) < 16 or recvdata[13] % 64 != 0 or len(recvdata[14:]) != recvdata[13]:
+            #Doesn't look like an ethernet message from a device
+            #(64-bytes chunks, length in second byte)
+            return False
+        
+        if recvdata[6:12] in self._devices:
+            device = self._devices[recvdata[6:12]]
+        elif recvdata[12:14] == b'\x88\xe1' and not self._discovery_homeplug:
+            #Any HomePlugAV adapter may answer, its PIB would be rewritten
+            return False
+        elif recvdata[12:14] != b'\x88\xe1' and recvdata[14] not in EtherDeviceFunctions:
+            #Only a PL7667 sends these
+            return False
+        else:
+            #Not from a known device
+            device = self._discover(recvdata[6:12])
+            if device is None:
+                return False
+        
+        if recvdata[12:14] == b'\x88\xe1':
             action = struct.unpack('<H',recvdata[15:17])[0]
             r = device.packet_homeplug(action, recvdata[20:])
         else:
@@ -265,11 +626,26 @@ class Server(threading.Thread):
         
     def _to_comma_separated(self, b):
         """Convert bytes to a colon separated string of hex-bytes"""
-        assert(type(v) == bytes)
+        assert(type(b) == bytes)
         return ":".join(['{0:02x}'.format(x) for x in b])
         
-    def report_data(self, device, is_on, power):
-        fields = ['{0:1.2f}'.format(time.time()),device.remote_mac]
+    def report_data(self, device, is_on, power, log = True):
+        """Record data in the history, and in the datalog if log is True"""
+        now = time.time()
+        if device.history is None:
+            self._allocate_history(device)
+        if device.history is not None:
+            device.history.append(now, is_on, power)
+        
+        if log:
+            self.log_data(device, is_on, power, now)
+        
+    def log_data(self, device, is_on, power, t):
+        """Write data (measured at time t) in the datalog"""
+        if self._datalog is None:
+            return
+        
+        fields = ['{0:1.2f}'.format(t),device.remote_mac]
         fields.append({True:'1',False:'0',None:''}[is_on])
         if power is None:
             fields.append('')
@@ -285,7 +661,8 @@ class Server(threading.Thread):
             raise ValueError("Invalid device {0}!".format(dev_mac))
         
         dev = self._devices[dev_mac_bytes]
-        return {'power': dev.device_power, 'is_on': dev.device_is_on, 'alias': dev.alias}
+        return {'power': dev.device_power, 'is_on': dev.device_is_on, 'alias': dev.alias,
+            'poll_interval': dev.poll_interval, 'probes_sent': dev.probes_sent, 'probes_saved': int(dev.probes_saved)}
         
     def device_info(self, dev_mac):
         """Get info from device"""
@@ -294,6 +671,59 @@ class Server(threading.Thread):
             return self._device_info(dev_mac)
         finally:
             self._lock_status.release()
+            
+    def _polling_report(self):
+        sent = sum([d.probes_sent for d in self._devices.values()])
+        saved = int(sum([d.probes_saved for d in self._devices.values()]))
+        return {'probes_sent': sent, 'probes_saved': saved}
+        
+    def polling_report(self):
+        """Get the number of probe frames sent in running state, and the
+        number of frames saved by adaptive polling"""
+        self._lock_status.acquire()
+        try:
+            return self._polling_report()
+        finally:
+            self._lock_status.release()
+            
+    def _provisioning_progress(self):
+        active = {}
+        for d in self._devices.values():
+            progress = d.pib_progress()
+            if progress is not None:
+                active[d.remote_mac] = {'state': d.state.__class__.__name__, 'offset': progress[0], 'size': progress[1]}
+        
+        return {'active': active, 'waiting': self._provisioning.waiting(),
+            'completed': self._provisioning.completed, 'aborted': self._provisioning.aborted,
+            'bytes_sent': self._provisioning.bytes_sent}
+        
+    def provisioning_progress(self):
+        """Get fleet-wide progress of PIB rewrites"""
+        self._lock_status.acquire()
+        try:
+            return self._provisioning_progress()
+        finally:
+            self._lock_status.release()
+            
+    def _device_history(self, dev_mac, since, until, period):
+        dev_mac_bytes = self._to_bytes(dev_mac)
+        if dev_mac_bytes not in self._devices:
+            raise ValueError("Invalid device {0}!".format(dev_mac))
+        
+        dev = self._devices[dev_mac_bytes]
+        if dev.history is None:
+            raise ValueError("No history for device {0}!".format(dev_mac))
+        return dev.history.get(since, until, period)
+        
+    def device_history(self, dev_mac, since = None, until = None, period = None):
+        """Get history of device as a numpy structured array: raw samples
+        (time, is_on, power) if period is None, otherwise downsampled
+        samples (time, min, max, avg, energy, count) for this period"""
+        self._lock_status.acquire()
+        try:
+            return self._device_history(dev_mac, since, until, period)
+        finally:
+            self._lock_status.release()
         
         
         
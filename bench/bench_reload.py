@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+#Benchmark of Server.reload with a large number of device sections.
+#The server thread isn't started, and the interface is set beforehand so
+#that no RAW socket is opened (root isn't needed).
+#
+#Usage: python3 bench/bench_reload.py [number of devices]
+
+import os
+import sys
+import time
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from asokapy.server import Server
+from asokapy.provisioning import ProvisioningScheduler
+
+def write_config(filename, num_devices, changed = None):
+    with open(filename, 'w') as f:
+        f.write('[master]\ninterface=bench0\nmac=00:11:22:33:44:55\nhistory_size=0\n')
+        for i in range(num_devices):
+            f.write('[00:13:c1:{0:02x}:{1:02x}:{2:02x}]\n'.format(i >> 16, (i >> 8) & 0xff, i & 0xff))
+            f.write('interval={0}\n'.format(3 if i == changed else 2))
+
+def make_server(config_file):
+    s = Server.__new__(Server)
+    threading.Thread.__init__(s)
+    s._config_file = config_file
+    s._lock_config = threading.RLock()
+    s._lock_status = threading.RLock()
+    s._provisioning = ProvisioningScheduler()
+    s._config_sections = {}
+    s._devices = {}
+    s._devices_list = []
+    s._devices_config = {}
+    s._discovered = set()
+    s._interface = 'bench0'
+    return s
+
+def timed(f):
+    start = time.time()
+    f()
+    return time.time() - start
+
+if __name__ == '__main__':
+    num_devices = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    fd, config_file = tempfile.mkstemp(suffix = '.ini')
+    os.close(fd)
+    try:
+        write_config(config_file, num_devices)
+        s = make_server(config_file)
+
+        print('devices\t{0}'.format(num_devices))
+        print('initial reload\t{0:1.3f} s'.format(timed(s._reload)))
+
+        config = []
+        print('parse (outside lock)\t{0:1.3f} s'.format(timed(lambda: config.append(s._read_config()))))
+        print('apply, no change\t{0:1.3f} s'.format(timed(lambda: s._reload(config[0]))))
+
+        write_config(config_file, num_devices, changed = 7)
+        config = [s._read_config()]
+        print('apply, one section changed\t{0:1.3f} s'.format(timed(lambda: s._reload(config[0]))))
+    finally:
+        os.remove(config_file)
@@ -0,0 +1,35 @@
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from asokapy.analytics import read_chunks
+
+def _read(filename):
+    chunks = list(read_chunks(filename))
+    return [numpy.concatenate(x) for x in zip(*chunks)]
+
+def test_read_chunks(tmp_path):
+    datalog = tmp_path / 'datalog'
+    datalog.write_bytes(b'1700000000.00\t00:13:c1:00:00:01\t1\t10.0\n'
+                        b'1700000010.00\t00:13:c1:00:00:01\t\t\n'
+                        b'1700000020.00\t00:13:c1:00:00:01\t0\t')
+    times, macs, is_on, power = _read(str(datalog))
+    #The last line is incomplete
+    assert list(times) == [1700000000., 1700000010.]
+    assert list(macs) == ['00:13:c1:00:00:01'] * 2
+    assert list(is_on) == [1, -1]
+    assert power[0] == 10. and numpy.isnan(power[1])
+
+def test_read_chunks_truncated_line(tmp_path):
+    #Partial line of an unclean shutdown, followed by the next run
+    datalog = tmp_path / 'datalog'
+    datalog.write_bytes(b'1700000000.00\t00:13:c1:00:00:01\t1\t10.0\n'
+                        b'1700000010.0'
+                        b'1700000100.00\t00:13:c1:00:00:01\t1\t10.0\n'
+                        b'1700000110.00\t00:13:c1:00:00:01\t1\t10.0\textra\n'
+                        b'1700000120.00\t00:13:c1:00:00:01\t1\n'
+                        b'1700000130.00\t00:13:c1:00:00:01\t1\tabc\n'
+                        b'1700000140.00\t00:13:c1:00:00:01\t1\t12.0\n')
+    times, macs, is_on, power = _read(str(datalog))
+    assert list(times) == [1700000000., 1700000140.]
+    assert list(power) == [10., 12.]
@@ -0,0 +1,32 @@
+from asokapy.device import parse_powerdata
+
+def test_parse_powerdata_blue():
+    data = parse_powerdata(b'2;a;1.2;1;15.5;b;c;3.4\r\n')
+    assert data.device_type == '2'
+    assert data.is_on is True
+    assert data.power == 15.5
+    assert data.version == ('1.2', '3.4')
+    assert data.unknown == ('a', 'b', 'c')
+
+def test_parse_powerdata_white():
+    data = parse_powerdata(b'3;a;1.2;0;0.0')
+    assert data.device_type == '3'
+    assert data.is_on is False
+    assert data.power == 0.
+    assert data.version == ('1.2', )
+    assert data.unknown == 'a'
+
+def test_parse_powerdata_malformed():
+    #Blue device with missing fields
+    assert parse_powerdata(b'2;a;1.2;1;15.5') is None
+    #Unknown device type
+    assert parse_powerdata(b'4;a;1.2;1;15.5') is None
+    #Too few fields
+    assert parse_powerdata(b'3;a;1.2;1') is None
+    #Invalid on/off
+    assert parse_powerdata(b'3;a;1.2;2;15.5') is None
+    #Invalid power
+    assert parse_powerdata(b'3;a;1.2;1;abc') is None
+    #Not ASCII
+    assert parse_powerdata(b'3;a;\xff;1;15.5') is None
+    assert parse_powerdata(b'') is None